@@ -1,21 +1,185 @@
+import copy
 import os
 import shlex
 import shutil
 import sys
+import tempfile
+import time
 import traceback
+import uuid
 from abc import ABC, abstractmethod
-from py_compile import compile
+from contextlib import contextmanager
+from py_compile import compile, PyCompileError
 from typing import MutableSequence, Tuple, Iterable, Union, Optional
 from zipapp import create_archive
 
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
 from mypy.api import run
 
+__all__ = ["CompilerError", "QCompiler", "QCompilerPYC", "QCompilerPYD", "QCompilerPYZ", "QCompilerEXE", "MultiCompiler",
+           "make_build_directory", "publish", "merge_directory", "lock_directory"]
+
 
 class CompilerError(Exception):
     def __init__(self, *args):
         super().__init__(*args)
 
 
+def make_build_directory(root: str, prefix: str = "build-") -> str:
+    """
+    Creates a unique scratch directory inside <root>, so concurrent builds never share their intermediate files.
+
+    :param root: The (shared) directory to create the scratch directory in, e.g. "obj"
+    :param prefix: Prefix for the name of the scratch directory
+    :return: The absolute path of the new scratch directory
+    """
+    root = os.path.abspath(root)
+    if not os.path.exists(root):
+        os.makedirs(root, exist_ok=True)
+    return tempfile.mkdtemp(prefix=prefix, dir=root)
+
+
+def publish(src: str, dst: str):
+    """
+    Moves <src> to <dst>, replacing <dst> if it already exists. <src> is first moved next to <dst> (copying it when
+    they're on different filesystems), so <dst> is only touched once the new version is complete.
+
+    Replacing a file is atomic: readers of <dst> either see the old or the new file. Replacing a folder takes two
+    renames, so <dst> is briefly missing; if the second rename fails the old folder is put back.
+
+    :param src: The file or folder to publish
+    :param dst: The final location of the file or folder
+    """
+    parent = os.path.dirname(os.path.abspath(dst))
+    if not os.path.exists(parent):
+        os.makedirs(parent, exist_ok=True)
+
+    # Stage next to the destination first, after this every rename stays on the same filesystem
+    staged = f"{dst}.tmp-{uuid.uuid4().hex}"
+    try:
+        shutil.move(src, staged)
+    except BaseException:
+        _remove_path(staged)
+        raise
+
+    try:
+        if os.path.exists(dst) and (os.path.isdir(staged) or os.path.isdir(dst)):
+            # A folder can't be renamed over an existing path, so move the old one out of the way first
+            old = f"{dst}.old-{uuid.uuid4().hex}"
+            os.replace(dst, old)
+            try:
+                os.replace(staged, dst)
+            except BaseException:
+                os.replace(old, dst)
+                raise
+            _remove_path(old)
+        else:
+            os.replace(staged, dst)
+    except BaseException:
+        _remove_path(staged)
+        raise
+
+
+def merge_directory(src: str, dst: str):
+    """
+    Moves the contents of folder <src> into folder <dst>, file by file. Files already in <dst> are replaced, other files
+    in <dst> are kept. Each file is moved with publish().
+
+    :param src: The folder to merge from
+    :param dst: The folder to merge into
+    """
+    if not os.path.isdir(dst):
+        publish(src, dst)
+        return
+
+    for item in os.listdir(src):
+        s_path = os.path.join(src, item)
+        d_path = os.path.join(dst, item)
+        if os.path.isdir(s_path) and os.path.isdir(d_path):
+            merge_directory(s_path, d_path)
+        else:
+            publish(s_path, d_path)
+
+
+def _remove_path(path: str):
+    """
+    Removes a file or folder, if it exists.
+
+    :param path: The file or folder to remove
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _try_lock_file(fd: int) -> bool:
+    """
+    Tries to take an exclusive lock on an open file without blocking. The operating system releases the lock when the
+    process dies, so a crashed build never leaves a stale lock behind.
+
+    :param fd: The file descriptor of the lock file
+    :return: True if the lock was taken
+    """
+    try:
+        if sys.platform == "win32":
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock_file(fd: int):
+    """
+    Releases the lock taken with _try_lock_file.
+
+    :param fd: The file descriptor of the lock file
+    """
+    if sys.platform == "win32":
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def lock_directory(directory: str, timeout: float = 60.0, poll_interval: float = 0.1):
+    """
+    Holds an exclusive lock on a directory shared between builds, e.g. "bin/pyz". The lock is taken on a
+    "<directory>.lock" file next to the directory. The file itself is left in place, only the lock on it matters.
+
+    :param directory: The directory to lock, it will be created if it doesn't exist
+    :param timeout: Seconds to wait for the lock before raising a CompilerError
+    :param poll_interval: Seconds to wait between attempts to take the lock
+    """
+    directory = os.path.abspath(directory)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    lock_file = directory.rstrip("\\/") + ".lock"
+
+    fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
+    try:
+        deadline = time.monotonic() + timeout
+        while not _try_lock_file(fd):
+            if time.monotonic() >= deadline:
+                raise CompilerError(f"Timed out waiting for lock on '{directory}'")
+            time.sleep(poll_interval)
+
+        try:
+            yield directory
+        finally:
+            _unlock_file(fd)
+    finally:
+        os.close(fd)
+
+
 class QCompiler(ABC):
     def __init__(self):
         pass
@@ -27,25 +191,32 @@ class QCompiler(ABC):
 
     @staticmethod
     def check_project(path: str):
-        run(path)
+        run([path])
 
 
 class QCompilerPYC(QCompiler):
-    def __init__(self, exclude: Iterable[str], path: str, clean: bool = True, optimize: int = 2, quiet: bool = False):
+    extension = ".pyc"
+
+    def __init__(self, exclude: Iterable[str], path: str, clean: bool = True, optimize: int = 2, quiet: bool = False,
+                 bin_root: Optional[str] = None, obj_root: Optional[str] = None):
         """
         Compiler for compiling python files to Compiled Python (.pyc) files.
 
         Parameters:
           exclude: An list of relative paths to exclude
           path: The path to be compiled into Compile Python (.pyc) files
-          clean: Cleans the output directory
+          clean: Replaces the previous output instead of merging into it
           optimize: An integer, 0 means no optimization, 1 means low level optimization, 2 means high level optimization
           quiet: ...
+          bin_root: The directory the compiled files are published to
+          obj_root: The directory unique per-build scratch directories are created in
 
         Defaults:
           clean: True
           optimize: 2  # High level optimization
           quiet: False  # Don't' suspress the output
+          bin_root: "./bin"
+          obj_root: "./obj"
 
         Types:
           exclude: Iterable[str]
@@ -53,6 +224,8 @@ class QCompilerPYC(QCompiler):
           clean: bool
           optimize: int
           quiet: bool
+          bin_root: Optional[str]
+          obj_root: Optional[str]
 
         :type quiet: bool
         :type optimize: int
@@ -67,7 +240,9 @@ class QCompilerPYC(QCompiler):
         self.optimize = optimize
         self.exclude = exclude
         self.path = path
-        self.output = os.path.join(os.getcwd(), "bin", "pyc")
+        self.binRoot = os.path.abspath(bin_root) if bin_root is not None else os.path.join(os.getcwd(), "bin")
+        self.objRoot = os.path.abspath(obj_root) if obj_root is not None else os.path.join(os.getcwd(), "obj")
+        self.output = os.path.join(self.binRoot, "pyc")
 
     def clean_directory(self, directory):
         for item in os.listdir(directory):
@@ -100,38 +275,61 @@ class QCompilerPYC(QCompiler):
 
     def compile_file(self, file, to=None):
         print(f"Compiling '{file}' to {os.path.splitext(to)[0]+'.pyc'}")
-        print(compile(file, os.path.splitext(to)[0]+".pyc", optimize=self.optimize))  # , quiet=self.quiet)
+        try:
+            print(compile(file, os.path.splitext(to)[0]+".pyc", doraise=True, optimize=self.optimize))  # , quiet=self.quiet)
+        except PyCompileError as e:
+            raise CompilerError(f"Failed to compile '{file}'") from e
 
     def compile(self):
         self.check_project(self.path)
 
         if not os.path.exists(self.path):
             os.makedirs(self.path)
-        if self.clean:
-            self.clean_directory(self.output)
-        if os.path.isdir(self.path):
-            self.compile_directory(self.path)
-        if os.path.isfile(self.path):
-            if os.path.splitext(self.path)[-1] == ".py":
-                self.compile_file(self.path, to=os.path.join(self.output, os.path.split(self.path)[-1]))
+
+        # Compile into a scratch directory first, so a failed build never leaves half-written output behind
+        name = os.path.split(self.path)[-1]
+        build_directory = make_build_directory(self.objRoot, "pyc-")
+        try:
+            if os.path.isdir(self.path):
+                self.compile_directory(self.path, os.path.join(build_directory, name))
+                with lock_directory(self.output):
+                    if self.clean:
+                        publish(os.path.join(build_directory, name), os.path.join(self.output, name))
+                    else:
+                        merge_directory(os.path.join(build_directory, name), os.path.join(self.output, name))
+            if os.path.isfile(self.path):
+                if os.path.splitext(self.path)[-1] == ".py":
+                    self.compile_file(self.path, to=os.path.join(build_directory, name))
+                    file = os.path.splitext(name)[0] + self.extension
+                    with lock_directory(self.output):
+                        publish(os.path.join(build_directory, file), os.path.join(self.output, file))
+        finally:
+            shutil.rmtree(build_directory, ignore_errors=True)
 
 
 class QCompilerPYD(QCompilerPYC):
-    def __init__(self, exclude: Iterable[str], path: str, clean: bool = True, optimize: int = 2, quiet: bool = False):
+    extension = ".pyd"
+
+    def __init__(self, exclude: Iterable[str], path: str, clean: bool = True, optimize: int = 2, quiet: bool = False,
+                 bin_root: Optional[str] = None, obj_root: Optional[str] = None):
         """
         Compiler for compiling python files to Python Extension (.pyd) files.
 
         Parameters:
           exclude: An list of relative paths to exclude
           path: The path to be compiled into Python Extension (.pyd) files
-          clean: Cleans the output directory
+          clean: Replaces the previous output instead of merging into it
           optimize: An integer, 0 means no optimization, 1 means low level optimization, 2 means high level optimization
           quiet: ...
+          bin_root: The directory the compiled files are published to
+          obj_root: The directory unique per-build scratch directories are created in
 
         Defaults:
           clean: True
           optimize: 2  # High level optimization
           quiet: False  # Don't' suspress the output
+          bin_root: "./bin"
+          obj_root: "./obj"
 
         Types:
           exclude: Iterable[str]
@@ -139,6 +337,8 @@ class QCompilerPYD(QCompilerPYC):
           clean: bool
           optimize: int
           quiet: bool
+          bin_root: Optional[str]
+          obj_root: Optional[str]
 
         :type quiet: bool
         :type optimize: int
@@ -146,16 +346,20 @@ class QCompilerPYD(QCompilerPYC):
         :type path: str
         """
 
-        super(QCompilerPYD, self).__init__(exclude, path, clean, optimize, quiet)
+        super(QCompilerPYD, self).__init__(exclude, path, clean, optimize, quiet, bin_root, obj_root)
 
-        self.output = os.path.join(os.getcwd(), "bin", "pyd")
+        self.output = os.path.join(self.binRoot, "pyd")
 
     def compile_file(self, file, to=None):
-        compile(file, dfile=os.path.splitext(to)[0]+".pyd", optimize=self.optimize, quiet=self.quiet)
+        try:
+            compile(file, cfile=os.path.splitext(to)[0]+".pyd", doraise=True, optimize=self.optimize, quiet=self.quiet)
+        except PyCompileError as e:
+            raise CompilerError(f"Failed to compile '{file}'") from e
 
 
 class QCompilerPYZ(QCompiler):
-    def __init__(self, path, name, main_class="Main", compressed=True, compiler: Optional[Union[QCompilerPYC, QCompilerPYD]]=None, clean: bool = True):
+    def __init__(self, path, name, main_class="Main", compressed=True, compiler: Optional[Union[QCompilerPYC, QCompilerPYD]]=None, clean: bool = True,
+                 bin_root: Optional[str] = None, obj_root: Optional[str] = None):
         super(QCompilerPYZ, self).__init__()
         self.clean = clean
         self.path = path
@@ -163,6 +367,9 @@ class QCompilerPYZ(QCompiler):
         self.mainClass = main_class
         self.compressed = compressed
         self.compiler = compiler
+        self.binRoot = os.path.abspath(bin_root) if bin_root is not None else os.path.join(os.getcwd(), "bin")
+        self.objRoot = os.path.abspath(obj_root) if obj_root is not None else os.path.join(os.getcwd(), "obj")
+        self.output = os.path.join(self.binRoot, "pyz")
 
     def create_archive(self, source, target):
         print(source, target)
@@ -203,28 +410,36 @@ class QCompilerPYZ(QCompiler):
         mod_path = self.path.replace('\\', '/')
         while mod_path.endswith("/"):
             mod_path = mod_path[:-1]
-        if not os.path.exists("bin/pyz/"):
-            os.makedirs("bin/pyz/")
 
-        if self.compiler is None:
-            self.create_archive(mod_path, f"bin/pyz/{self.name}")
-        else:
-            if not os.path.exists("obj/pyz/"):
-                os.makedirs("obj/pyz/")
-            self.clean_directory("obj/pyz/")
-            if type(self.compiler) == QCompilerPYC:
-                compilerpath = "bin/pyc"
-            elif type(self.compiler) == QCompilerPYD:
-                compilerpath = "bin/pyd"
+        # Every build gets its own scratch directory, the results are only published to the output when complete
+        build_directory = make_build_directory(os.path.join(self.objRoot, "pyz"), "pyz-")
+        archive = os.path.join(build_directory, self.name)
+        try:
+            if self.compiler is None:
+                self.create_archive(mod_path, archive)
+                with lock_directory(self.output):
+                    publish(archive, os.path.join(self.output, self.name))
             else:
-                raise CompilerError(f"Incompatible compiler: {type(self.compiler).__name__}")
-            if not os.path.exists(f"obj/pyz/{compilerpath}"):
-                os.makedirs(f"obj/pyz/{compilerpath}")
-            self.compiler.output = f"obj/pyz/{compilerpath}"
-            self.compiler.compile()
-            self.create_archive(f"obj/pyz/{compilerpath}/{os.path.split(self.path)[-1]}", f"bin/pyz/{self.name}")
-            self.copy_additional_files(self.path, "bin/pyz/")
-            print(f"Compiled to: bin/pyz/{self.name}")
+                if type(self.compiler) == QCompilerPYC:
+                    compilerpath = os.path.join("bin", "pyc")
+                elif type(self.compiler) == QCompilerPYD:
+                    compilerpath = os.path.join("bin", "pyd")
+                else:
+                    raise CompilerError(f"Incompatible compiler: {type(self.compiler).__name__}")
+                # Compile with a copy, so the caller's compiler never points into this build's scratch directory
+                compiler = copy.copy(self.compiler)
+                compiler.output = os.path.join(build_directory, compilerpath)
+                compiler.objRoot = build_directory
+                compiler.compile()
+                self.create_archive(os.path.join(build_directory, compilerpath, os.path.split(self.path)[-1]), archive)
+                additional_files = os.path.join(build_directory, "files")
+                self.copy_additional_files(self.path, additional_files)
+                with lock_directory(self.output):
+                    publish(archive, os.path.join(self.output, self.name))
+                    merge_directory(additional_files, self.output)
+            print(f"Compiled to: {os.path.join(self.output, self.name)}")
+        finally:
+            shutil.rmtree(build_directory, ignore_errors=True)
 
 
 # noinspection PyUnusedClass
@@ -238,7 +453,8 @@ class QCompilerEXE(object):
                  key: str = None, debug: str = None, no_unicode=False, clean=False, apply_symbol_table=False,
                  no_upx=False, version_file: str = None, manifest_file: str = None, uac_admin=False, uac_uiaccess=False,
                  win_private_assemblies=False, win_no_prefer_redirects=False, osx_bundle_indentifier: str = None,
-                 runtime_tmpdir: str = "", bootloader_ignore_signals=False, *additional_args):
+                 runtime_tmpdir: str = "", bootloader_ignore_signals=False, *additional_args,
+                 bin_root: Optional[str] = None, obj_root: Optional[str] = None):
         """
         Compiler class, compiling python workspace.
 
@@ -275,6 +491,8 @@ class QCompilerEXE(object):
         :param runtime_tmpdir:
         :param bootloader_ignore_signals:
         :param additional_args:
+        :param bin_root: Directory the application is published to, defaults to "<main_folder>/bin"
+        :param obj_root: Directory the per-build scratch directories are created in, defaults to "<main_folder>/obj"
         """
 
         # Replace None with the default value
@@ -295,6 +513,8 @@ class QCompilerEXE(object):
         self.exclude = exclude
         self.icon = icon
         self.allFiles = []
+        self.binRoot = bin_root if bin_root is not None else self.join_path(main_folder, "bin")
+        self.objRoot = obj_root if obj_root is not None else self.join_path(main_folder, "obj")
 
         # General Options
         self.upxDirectory = upx_dir
@@ -384,13 +604,12 @@ class QCompilerEXE(object):
         """
         from PyInstaller import __main__ as pyi
 
-        # Initialize variables
-        temporary_directory = self.join_path(self.mainFolder, "obj")
-        output = self.join_path(self.mainFolder, "bin")
+        # Initialize variables, every build gets its own temporary directory
+        temporary_directory = make_build_directory(self.objRoot, "exe-")
+        output = self.binRoot
 
         # Notify the user of the workspace and setup building to it
-        print("Building in the current instances temporary directory at {}".format(temporary_directory))
-        print("To get a new temporary directory, restart this application")
+        print("Building in a new temporary directory at {}".format(temporary_directory))
         dist_path = os.path.join(temporary_directory, 'application')
         build_path = os.path.join(temporary_directory, 'build')
         extra_args = ['--distpath', dist_path] + ['--workpath', build_path] + ['--specpath', temporary_directory]
@@ -398,14 +617,20 @@ class QCompilerEXE(object):
         # Run PyInstaller
         sys.argv = shlex.split(command) + extra_args  # Put command into sys.argv and extra args
         print("Executing: {0}".format(command))
-        pyi.run()  # Execute PyInstaller
-        print("An error occurred, traceback follows:", file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        try:
+            pyi.run()  # Execute PyInstaller
+        except (Exception, SystemExit) as e:
+            if not isinstance(e, SystemExit) or e.code not in (None, 0):
+                print("An error occurred, traceback follows:", file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+                raise CompilerError(f"PyInstaller failed, the temporary directory is kept at: "
+                                    f"{temporary_directory}") from e
 
         # Move project if there was no failure
         output_directory = os.path.abspath(output)  # Use absolute directories
         print("Moving project to: {0}".format(output_directory))
         self.move_project(dist_path, output_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
         print("Complete.")
 
     @staticmethod
@@ -417,21 +642,11 @@ class QCompilerEXE(object):
         :return:
         """
         """ Move the output package to the desired path (default is output/ - set in script.js) """
-        # Make sure the destination exists
-        if not os.path.exists(dst):
-            os.makedirs(dst)
-
-        # Move all files/folders in dist/
-        for file_or_folder in os.listdir(src):
-            _dst = os.path.join(dst, file_or_folder)
-            # If this already exists in the destination, delete it
-            if os.path.exists(_dst):
-                if os.path.isfile(_dst):
-                    os.remove(_dst)
-                else:
-                    shutil.rmtree(_dst)
-            # Move file
-            shutil.move(os.path.join(src, file_or_folder), dst)
+        # Lock the destination, it's shared with other builds
+        with lock_directory(dst):
+            # Move all files/folders in dist/, replacing what already exists in the destination
+            for file_or_folder in os.listdir(src):
+                publish(os.path.join(src, file_or_folder), os.path.join(dst, file_or_folder))
 
     @staticmethod
     def join_path(path, *paths):
@@ -443,10 +658,25 @@ class QCompilerEXE(object):
         """
         return os.path.join(path, *paths).replace("\\", "/")
 
-    def _reindex_relpath(self, folder):
+    def _reindex_ignored(self):
+        """
+        Gets the relative paths that are never indexed, like the build roots and their lock files
+        :return:
+        """
+        ignored = ["bin", "obj", "__pycache__", self.mainFile]
+        for root in (self.binRoot, self.objRoot):
+            try:
+                relpath = os.path.relpath(root, self.mainFolder).replace("\\", "/")
+            except ValueError:  # On another drive, so it can't be inside the main folder
+                continue
+            ignored += [relpath, relpath + ".lock"]
+        return ignored
+
+    def _reindex_relpath(self, folder, ignored):
         """
         Reindex's the relative path to <folder>
         :param folder:
+        :param ignored: The relative paths to skip, see _reindex_ignored
         :return:
         """
         for export_path in os.listdir(self.join_path(self.mainFolder, folder)):
@@ -454,14 +684,14 @@ class QCompilerEXE(object):
             path = self.join_path(self.mainFolder, export_path)
             if export_path in self.exclude:
                 continue
-            if export_path not in ["bin", "obj", "__pycache__", self.mainFile]:
+            if export_path not in ignored:
                 if os.path.split(export_path)[-1] not in ["__pycache__"]:
                     if os.path.isfile(path):
                         print("Indexed File: (%s, %s)" % (path, os.path.join(*os.path.split(export_path)[:-1])))
                         self.allFiles.append((path, os.path.join(*os.path.split(export_path)[:-1])))
                     if os.path.isdir(path):
                         print("Indexed Folder: %s" % export_path)
-                        self._reindex_relpath(export_path)
+                        self._reindex_relpath(export_path, ignored)
 
     def reindex(self):
         """
@@ -469,17 +699,18 @@ class QCompilerEXE(object):
         :return:
         """
         self.allFiles = []
+        ignored = self._reindex_ignored()
         for export_path in self.mainContents:
             path = self.join_path(self.mainFolder, export_path)
             if export_path in self.exclude:
                 continue
-            if export_path not in ["bin", "obj", "__pycache__", self.mainFile]:
+            if export_path not in ignored:
                 if os.path.isfile(path):
                     print("Indexed File: (%s, %s)" % (path, "."))
                     self.allFiles.append((path, "."))
                 if os.path.isdir(path):
                     print("Indexed Folder: %s" % export_path)
-                    self._reindex_relpath(export_path)
+                    self._reindex_relpath(export_path, ignored)
 
     def get_args(self) -> list:
         """
@@ -615,6 +846,11 @@ class MultiCompiler(QCompilerEXE):
     def compile(self, commands):
         for compiler in self.compilers:
             compiler.compile(compiler.get_command(compiler.get_args()))
-        for folder in self.binFolders:
-            for inner_folder in os.listdir(folder):
-                os.rename(f"bin/{folder}/{inner_folder}", f"bin/{self.appName}/{inner_folder}")
+        for compiler, folder in zip(self.compilers, self.binFolders):
+            # Hold the same lock as move_project, so no other build replaces <folder> while it's being merged
+            with lock_directory(compiler.binRoot):
+                src = self.join_path(compiler.binRoot, folder)
+                if not os.path.isdir(src):
+                    raise CompilerError(f"Compiler with mainfile '{compiler.mainFile}' produced no output at '{src}'")
+                # The onedir outputs share dependency folders, so merge them instead of replacing them
+                merge_directory(src, self.join_path(compiler.binRoot, self.appName))
@@ -0,0 +1,27 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile
+
+from qcompiler import QCompilerPYZ, QCompilerPYC
+
+
+pre_compiler = QCompilerPYC([], "TestProgram")
+names = ["TestProgram1.pyz", "TestProgram2.pyz"]
+
+
+def build(name):
+    # Both builds share one pre-compiler and the same bin/pyz and obj/pyz directories
+    compiler = QCompilerPYZ("TestProgram", name, "__init__:main", False, pre_compiler, True)
+    compiler.compile()
+
+
+with ThreadPoolExecutor(len(names)) as executor:
+    list(executor.map(build, names))
+
+for name in names:
+    with ZipFile(os.path.join("bin", "pyz", name)) as archive:
+        assert "__init__.pyc" in archive.namelist(), archive.namelist()
+assert os.path.isfile(os.path.join("bin", "pyz", "test.txt"))
+assert os.listdir(os.path.join("obj", "pyz")) == []
+assert pre_compiler.output == os.path.join(os.getcwd(), "bin", "pyc")
+print("Concurrent builds succeeded")
@@ -0,0 +1,210 @@
+import errno
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "py"))
+
+from qcompiler.qcompiler import CompilerError, QCompiler, QCompilerPYC, QCompilerPYD, QCompilerPYZ, \
+    lock_directory, make_build_directory, merge_directory, publish
+
+
+def write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(contents)
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, *paths):
+        return os.path.join(self.directory, *paths)
+
+
+class TestMakeBuildDirectory(TemporaryDirectoryTestCase):
+    def test_unique(self):
+        first = make_build_directory(self.path("obj"), "pyz-")
+        second = make_build_directory(self.path("obj"), "pyz-")
+
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
+        self.assertEqual(os.path.dirname(first), self.path("obj"))
+        self.assertTrue(os.path.basename(first).startswith("pyz-"))
+
+
+class TestPublish(TemporaryDirectoryTestCase):
+    def test_replace_file(self):
+        write(self.path("build", "app.pyz"), "new")
+        write(self.path("bin", "app.pyz"), "old")
+
+        publish(self.path("build", "app.pyz"), self.path("bin", "app.pyz"))
+
+        self.assertEqual(read(self.path("bin", "app.pyz")), "new")
+        self.assertFalse(os.path.exists(self.path("build", "app.pyz")))
+        self.assertEqual(os.listdir(self.path("bin")), ["app.pyz"])
+
+    def test_replace_directory(self):
+        write(self.path("build", "app", "new.txt"), "new")
+        write(self.path("bin", "app", "old.txt"), "old")
+
+        publish(self.path("build", "app"), self.path("bin", "app"))
+
+        self.assertEqual(os.listdir(self.path("bin", "app")), ["new.txt"])
+        self.assertEqual(os.listdir(self.path("bin")), ["app"])
+
+    def test_creates_parent(self):
+        write(self.path("build", "app.pyz"), "new")
+
+        publish(self.path("build", "app.pyz"), self.path("bin", "pyz", "app.pyz"))
+
+        self.assertEqual(read(self.path("bin", "pyz", "app.pyz")), "new")
+
+    def test_cross_filesystem(self):
+        write(self.path("build", "app", "new.txt"), "new")
+        write(self.path("bin", "app", "old.txt"), "old")
+
+        # shutil.move falls back to copying when a rename crosses filesystems
+        with mock.patch("os.rename", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            publish(self.path("build", "app"), self.path("bin", "app"))
+
+        self.assertEqual(os.listdir(self.path("bin", "app")), ["new.txt"])
+        self.assertEqual(os.listdir(self.path("bin")), ["app"])
+        self.assertFalse(os.path.exists(self.path("build", "app")))
+
+    def test_failed_swap_restores_directory(self):
+        write(self.path("build", "app", "new.txt"), "new")
+        write(self.path("bin", "app", "old.txt"), "old")
+        replace = os.replace
+
+        def fail_second_rename(src, dst):
+            if os.path.basename(src).startswith("app.tmp-"):
+                raise OSError(errno.EACCES, "Permission denied")
+            replace(src, dst)
+
+        with mock.patch("os.replace", side_effect=fail_second_rename):
+            with self.assertRaises(OSError):
+                publish(self.path("build", "app"), self.path("bin", "app"))
+
+        self.assertEqual(os.listdir(self.path("bin", "app")), ["old.txt"])
+        self.assertEqual(os.listdir(self.path("bin")), ["app"])
+
+
+class TestMergeDirectory(TemporaryDirectoryTestCase):
+    def test_keeps_other_files(self):
+        write(self.path("first", "data", "a.txt"), "a")
+        write(self.path("second", "data", "b.txt"), "b")
+        write(self.path("second", "data", "a.txt"), "a2")
+
+        merge_directory(self.path("first"), self.path("bin"))
+        merge_directory(self.path("second"), self.path("bin"))
+
+        self.assertEqual(sorted(os.listdir(self.path("bin", "data"))), ["a.txt", "b.txt"])
+        self.assertEqual(read(self.path("bin", "data", "a.txt")), "a2")
+
+
+class TestLockDirectory(TemporaryDirectoryTestCase):
+    def test_timeout(self):
+        with lock_directory(self.path("bin")):
+            with self.assertRaises(CompilerError):
+                with lock_directory(self.path("bin"), timeout=0.2):
+                    pass
+
+    def test_released_on_exception(self):
+        with self.assertRaises(RuntimeError):
+            with lock_directory(self.path("bin")):
+                raise RuntimeError()
+
+        with lock_directory(self.path("bin"), timeout=0.2):
+            pass
+
+    def test_released_when_process_dies(self):
+        # A killed process can't clean up after itself, the operating system has to release the lock
+        holder = subprocess.Popen(
+            [sys.executable, "-c", "import sys, time\n"
+                                   f"sys.path.insert(0, {sys.path[0]!r})\n"
+                                   "from qcompiler.qcompiler import lock_directory\n"
+                                   f"with lock_directory({self.path('bin')!r}):\n"
+                                   "    print('locked', flush=True)\n"
+                                   "    time.sleep(60)\n"],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), "locked")
+            with self.assertRaises(CompilerError):
+                with lock_directory(self.path("bin"), timeout=0.2):
+                    pass
+        finally:
+            holder.kill()
+            holder.wait()
+            holder.stdout.close()
+
+        with lock_directory(self.path("bin"), timeout=5):
+            pass
+
+
+@mock.patch.object(QCompiler, "check_project")
+class TestCompilerPYC(TemporaryDirectoryTestCase):
+    compiler = QCompilerPYC
+
+    def compiler_for(self, name):
+        return self.compiler([], self.path(name), bin_root=self.path("bin"), obj_root=self.path("obj"))
+
+    def test_compile_directory(self, check_project):
+        write(self.path("Good", "a.py"), "a = 1\n")
+
+        compiler = self.compiler_for("Good")
+        compiler.compile()
+
+        self.assertEqual(os.listdir(os.path.join(compiler.output, "Good")), ["a" + compiler.extension])
+        self.assertEqual(os.listdir(self.path("obj")), [])
+
+    def test_failed_build_keeps_previous_output(self, check_project):
+        write(self.path("Bad", "a.py"), "a = 1\n")
+        write(self.path("Bad", "b.py"), "b = 2\n")
+        compiler = self.compiler_for("Bad")
+        compiler.compile()
+        previous = sorted(os.listdir(os.path.join(compiler.output, "Bad")))
+
+        write(self.path("Bad", "a.py"), "a =\n")
+        with self.assertRaises(CompilerError):
+            compiler.compile()
+
+        self.assertEqual(sorted(os.listdir(os.path.join(compiler.output, "Bad"))), previous)
+        self.assertEqual(os.listdir(self.path("obj")), [])
+
+
+class TestCompilerPYD(TestCompilerPYC):
+    compiler = QCompilerPYD
+
+
+@mock.patch.object(QCompiler, "check_project")
+class TestCompilerPYZ(TemporaryDirectoryTestCase):
+    def test_removes_scratch_directory(self, check_project):
+        write(self.path("App", "__init__.py"), "def main():\n    pass\n")
+        write(self.path("App", "data", "a.txt"), "a")
+        pre_compiler = QCompilerPYC([], self.path("App"))
+
+        for name in ("App1.pyz", "App2.pyz"):
+            QCompilerPYZ(self.path("App"), name, "__init__:main", False, pre_compiler, False,
+                         bin_root=self.path("bin"), obj_root=self.path("obj")).compile()
+
+        self.assertEqual(sorted(os.listdir(self.path("bin", "pyz"))), ["App1.pyz", "App2.pyz", "data"])
+        self.assertEqual(os.listdir(self.path("obj", "pyz")), [])
+
+
+if __name__ == '__main__':
+    unittest.main()